@@ -1,3 +1,10 @@
 MODEL_NAME = "gpt-4o-mini"
+MODEL_TEMPERATURE = 0.0
+LLM_CACHE_SIZE = 256
+TRANSCRIPTION_MODEL = "whisper-1"
 DATASET_DB = "c-metrics/hallucination"
-PROJECT_NAME = "audio_query_data"
\ No newline at end of file
+PROJECT_NAME = "audio_query_data"
+EVAL_CACHE_DB = "cache.db"
+EVAL_CACHE_TTL_DAYS = 7
+EVAL_MAX_CONCURRENCY = 8
+MAX_RECORDING_SECONDS = 300
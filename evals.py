@@ -9,26 +9,91 @@ Author: Prateek Chhikara
 
 import asyncio
 import weave
-import json
-import numpy as np
-from utils import generate_response
-from prompts import COLUMN_SELECTION_PROMPT, QUERY_PROMPT
+import orjson
+import hashlib
+import os
+import sqlite3
+import time
+import pandas as pd
+from utils import agenerate_response, get_fields_description, call_weave
+from filters import filter_frame, optimize_expr, queries_match
+from prompts import COMBINED_PROMPT
 from weave import Model
+from config import MODEL_NAME, MODEL_TEMPERATURE, PROJECT_NAME, EVAL_CACHE_DB, EVAL_CACHE_TTL_DAYS, EVAL_MAX_CONCURRENCY
 
-# Initialize Weave with project name
-weave.init('audio_query_data')
+# Rows used to score query execution and the rows selected by each ground
+# truth filter, computed once when the evaluation is run
+eval_frame = pd.DataFrame()
+gt_masks = []
 
-@weave.op()
-def get_fields_description():
+# Bound the number of concurrent API requests to respect rate limits
+_llm_semaphore = asyncio.Semaphore(EVAL_MAX_CONCURRENCY)
+
+def init_eval_cache():
+    """Create the table of the local response cache, if it does not exist yet."""
+    with sqlite3.connect(EVAL_CACHE_DB) as conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS prompt_cache ("
+            "prompt_hash TEXT PRIMARY KEY, "
+            "response_text TEXT NOT NULL, "
+            "created_at REAL NOT NULL, "
+            "ttl_days INTEGER NOT NULL)"
+        )
+
+def _load_cached_response(key):
+    """Return the unexpired cached response text for a key, or None on a miss."""
+    with sqlite3.connect(EVAL_CACHE_DB) as conn:
+        row = conn.execute(
+            "SELECT response_text FROM prompt_cache "
+            "WHERE prompt_hash = ? AND created_at + ttl_days * 86400 > ?",
+            (key, time.time())
+        ).fetchone()
+    return row[0] if row is not None else None
+
+def _store_cached_response(key, response_text):
+    """Store the response text for a key in the local cache."""
+    with sqlite3.connect(EVAL_CACHE_DB) as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO prompt_cache VALUES (?, ?, ?, ?)",
+            (key, response_text, time.time(), EVAL_CACHE_TTL_DAYS)
+        )
+
+async def _cached_generate_response(user_query, fields, prior, prompt):
     """
-    Get the description of database fields from the columns.json file.
+    Generate a response, reusing a previous result stored in the local cache.
+    
+    Responses are keyed by a SHA-256 hash of the model settings, the prompt
+    template and its inputs, and persisted to a SQLite database created by
+    init_eval_cache, so repeated evaluation runs only hit the API for prompts
+    that have not been seen before. The database is accessed in a worker
+    thread so it does not block the event loop. Set the EVAL_CACHE_REFRESH
+    environment variable to force fresh responses.
     
+    Args:
+        user_query (str): The natural language query from the user
+        fields (str): Description of available database columns
+        prior (list or str): Columns that have been selected for the query
+        prompt (dict): The prompt to use, with "system" and "user" parts
+        
     Returns:
-        dict: A dictionary containing column names and their descriptions
+        dict: The parsed JSON response
     """
-    with open("columns.json", "r") as f:
-        columns_with_description = json.load(f)
-    return columns_with_description
+    key = hashlib.sha256(orjson.dumps(
+        [MODEL_NAME, MODEL_TEMPERATURE, prompt, user_query, fields, prior],
+        option=orjson.OPT_SORT_KEYS
+    )).hexdigest()
+    refresh = os.getenv("EVAL_CACHE_REFRESH", "").lower() in ("1", "true", "yes")
+
+    cached = None if refresh else await asyncio.to_thread(_load_cached_response, key)
+    if cached is not None:
+        return orjson.loads(cached)
+
+    # Only call the API on a cache miss
+    async with _llm_semaphore:
+        response = await agenerate_response(user_query, fields, prior, prompt)
+
+    await asyncio.to_thread(_store_cached_response, key, orjson.dumps(response).decode())
+    return response
 
 # Test queries for evaluation
 user_queries = [
@@ -180,6 +245,9 @@ eval_dataset = [
     {'id': '9', 'user_query': user_queries[9], 'gt_filters': gt_filters[9]}
 ]
 
+# Number of test queries to evaluate, defaulting to the full dataset
+EVAL_SIZE = int(os.getenv("EVAL_SIZE", len(eval_dataset)))
+
 class QueryEvalModel(Model):
     """
     Model for evaluating query generation accuracy.
@@ -189,7 +257,7 @@ class QueryEvalModel(Model):
     """
     
     @weave.op()
-    def predict(self, user_query: str) -> dict:
+    async def predict(self, user_query: str) -> dict:
         """
         Generate a database query from a user query.
         
@@ -199,68 +267,84 @@ class QueryEvalModel(Model):
         Returns:
             dict: A dictionary containing the generated database query
         """
-        # First, identify required columns based on the query
-        query = generate_response(
+        # Select the required columns and generate the query in a single request
+        query = (await _cached_generate_response(
             user_query, 
             get_fields_description(), 
             "", 
-            COLUMN_SELECTION_PROMPT
-        )["columns"]
-        
-        # Then, generate the final query using the identified columns
-        query = generate_response(
-            user_query, 
-            get_fields_description(), 
-            query, 
-            QUERY_PROMPT
-        )["query"]
+            COMBINED_PROMPT
+        ))["query"]
         
-        return {"query": query}
+        # Simplify the generated query, as the application does before running it
+        return {"query": optimize_expr(query)}
 
 @weave.op()
-async def query_accuracy_score(user_query, output):
+def query_accuracy_score(gt_filters, output):
     """
     Calculate the accuracy score for a generated query.
     
-    This function compares the generated query with an expected query
-    generated using the same pipeline.
+    This function compares the generated query with the ground truth
+    filter for the test query, after rewriting both into a canonical form
+    so that equivalent ways of writing the same condition still match.
     
     Args:
-        user_query (str): The natural language query from the user
+        gt_filters (dict): The ground truth filter for the test query
         output (dict): The output from the QueryEvalModel
         
     Returns:
         dict: A dictionary containing the accuracy score (1 for match, 0 for mismatch)
     """
-    # Generate the expected query using the same pipeline
-    expected_query = generate_response(
-        user_query, 
-        get_fields_description(), 
-        "", 
-        COLUMN_SELECTION_PROMPT
-    )["columns"]
+    # Compare the canonical forms of the generated query and the ground truth filter
+    score = 1 if queries_match(output["query"], gt_filters) else 0
+    return {"accuracy": score}
+
+@weave.op()
+def query_execution_score(id, output):
+    """
+    Calculate the execution accuracy score for a generated query.
     
-    expected_query = generate_response(
-        user_query, 
-        get_fields_description(), 
-        expected_query, 
-        QUERY_PROMPT
-    )["query"]
+    This function applies the generated query and the ground truth filter
+    to the evaluation rows and checks that both select the same rows, so
+    equivalent queries written differently still count as a match.
     
-    # Compare the generated query with the expected query
-    score = 1 if expected_query == output["query"] else 0
-    return {"accuracy": score}
+    Args:
+        id (str): The identifier of the test query
+        output (dict): The output from the QueryEvalModel
+        
+    Returns:
+        dict: A dictionary containing the execution accuracy score (1 for match, 0 for mismatch)
+    """
+    try:
+        predicted_mask = filter_frame(eval_frame, output["query"])
+    except (ValueError, TypeError, KeyError):
+        return {"execution_accuracy": 0}
+
+    return {"execution_accuracy": 1 if predicted_mask.equals(gt_masks[int(id)]) else 0}
 
 # Initialize the evaluation model
 model = QueryEvalModel()
 
-# Create an evaluation with the test dataset
-evaluation = weave.Evaluation(
-    dataset=[{"user_query": eval["user_query"]} for eval in eval_dataset], 
-    scorers=[query_accuracy_score]
-)
-
 # Run the evaluation
 if __name__ == "__main__":
+    # Initialize Weave with project name
+    weave.init(PROJECT_NAME)
+    init_eval_cache()
+    
+    # Fetch the rows used to score query execution and apply the ground truth filters
+    eval_frame, status_code = call_weave(None)
+    if status_code != 200:
+        print("Could not fetch the evaluation rows, query execution will not be scored")
+    gt_masks = [filter_frame(eval_frame, gt_filter) for gt_filter in gt_filters]
+    
+    # Create an evaluation with the test dataset
+    evaluation = weave.Evaluation(
+        dataset=[
+            {"id": eval["id"], "user_query": eval["user_query"], "gt_filters": eval["gt_filters"]}
+            for eval in eval_dataset[:EVAL_SIZE]
+        ], 
+        # Execution accuracy can only be scored when the evaluation rows were fetched
+        scorers=[query_accuracy_score] + ([query_execution_score] if not eval_frame.empty else [])
+    )
+    
     asyncio.run(evaluation.evaluate(model))
     print("Evaluation completed successfully!")
@@ -0,0 +1,374 @@
+"""
+Audio Query Processor - Query Filters
+
+This module evaluates the MongoDB-style filter queries used by Weave with
+vectorized pandas operations, so that a filter can be applied locally to rows
+that have already been fetched from the database, and compares and simplifies
+generated queries.
+
+Author: Prateek Chhikara
+"""
+
+import functools
+import math
+import orjson
+import pandas as pd
+from operator import eq, ge, gt, le, lt
+
+def _to_double(value):
+    """
+    Convert a value to a float, mirroring the $convert operator.
+    
+    Values that cannot be converted become NaN, so every comparison
+    against them evaluates to False.
+    
+    Args:
+        value: The value to convert
+    
+    Returns:
+        float: The converted value, or NaN if the conversion failed
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+def _contains(value, substr, case_insensitive=False):
+    """
+    Check whether a string field contains a substring, mirroring $contains.
+    
+    Args:
+        value: The field value to search in
+        substr (str): The substring to search for
+        case_insensitive (bool): Whether to ignore case
+    
+    Returns:
+        bool: True if the field is a string containing the substring
+    """
+    if not isinstance(value, str):
+        return False
+    if case_insensitive:
+        return substr.lower() in value.lower()
+    return substr in value
+
+# Converters supported by the $convert operator
+_CONVERTERS = {
+    "double": _to_double,
+    "int": _to_double,
+    "string": str
+}
+
+# Vectorized equivalents of the comparison operators
+_FRAME_COMPARISONS = {
+    "$eq": eq,
+    "$gt": gt,
+    "$gte": ge,
+    "$lt": lt,
+    "$lte": le
+}
+
+def _frame_value(expr, frame):
+    """
+    Evaluate a filter expression against a whole DataFrame at once.
+    
+    Args:
+        expr (dict): The filter expression to evaluate
+        frame (pandas.DataFrame): The rows, with one column per dotted field path
+        
+    Returns:
+        pandas.Series or scalar: The column-wise result of the expression
+        
+    Raises:
+        ValueError: If the expression uses an unsupported operator
+    """
+    if not isinstance(expr, dict) or len(expr) != 1:
+        raise ValueError(f"Unsupported filter expression: {expr!r}")
+    
+    (operator, operand), = expr.items()
+    
+    if operator == "$expr":
+        return _frame_value(operand, frame)
+    
+    if operator in ("$and", "$or"):
+        conditions = [_frame_condition(item, frame) for item in operand]
+        if not conditions:
+            return operator == "$and"
+        combine = (lambda a, b: a & b) if operator == "$and" else (lambda a, b: a | b)
+        return functools.reduce(combine, conditions)
+    
+    if operator == "$not":
+        inner = operand[0] if isinstance(operand, list) else operand
+        return ~_frame_condition(inner, frame)
+    
+    if operator in _FRAME_COMPARISONS:
+        left, right = (_frame_value(item, frame) for item in operand)
+        result = _FRAME_COMPARISONS[operator](left, right)
+        # Comparisons against missing values are unknown rather than false
+        unknown = _is_missing(left) | _is_missing(right)
+        if isinstance(result, pd.Series):
+            return result.astype("boolean").mask(unknown, pd.NA)
+        return pd.NA if unknown else result
+    
+    if operator == "$in":
+        needle, haystack = operand
+        values = [_frame_value(item, frame) for item in haystack]
+        needle = _frame_value(needle, frame)
+        if isinstance(needle, pd.Series):
+            return needle.isin(values)
+        return needle in values
+    
+    if operator == "$contains":
+        value = _frame_value(operand["input"], frame)
+        substr = _frame_value(operand["substr"], frame)
+        case_insensitive = bool(operand.get("case_insensitive", False))
+        if isinstance(value, pd.Series):
+            if not (pd.api.types.is_object_dtype(value) or pd.api.types.is_string_dtype(value)):
+                return False
+            return value.str.contains(substr, case=not case_insensitive, regex=False, na=False).astype(bool)
+        return _contains(value, substr, case_insensitive)
+    
+    if operator == "$getField":
+        path = str(operand)
+        if path in frame.columns:
+            return frame[path]
+        return pd.Series(math.nan, index=frame.index)
+    
+    if operator == "$literal":
+        return operand
+    
+    if operator == "$convert" and operand.get("to") in _CONVERTERS:
+        value = _frame_value(operand["input"], frame)
+        if not isinstance(value, pd.Series):
+            return _CONVERTERS[operand["to"]](value)
+        if operand["to"] == "string":
+            return value.astype(str)
+        return pd.to_numeric(value, errors="coerce")
+    
+    raise ValueError(f"Unsupported filter operator: {operator}")
+
+def _is_missing(value):
+    """Check which values are missing, element-wise for a Series."""
+    if isinstance(value, pd.Series):
+        return value.isna()
+    return isinstance(value, float) and math.isnan(value)
+
+def _frame_condition(expr, frame):
+    """
+    Evaluate a condition to a nullable boolean Series over a DataFrame.
+    
+    Rows where the condition is unknown, because it compares a missing
+    value, are NA, so they stay unknown when the condition is negated and
+    combine with $and/$or following three-valued logic, as in SQL.
+    
+    Args:
+        expr (dict): The condition to evaluate
+        frame (pandas.DataFrame): The rows to evaluate it against
+        
+    Returns:
+        pandas.Series: A nullable boolean Series aligned with the rows of the frame
+    """
+    result = _frame_value(expr, frame)
+    if isinstance(result, pd.Series):
+        return result.astype("boolean")
+    return pd.Series(result, index=frame.index, dtype="boolean")
+
+def _frame_mask(expr, frame):
+    """
+    Evaluate a filter expression to a boolean mask over a DataFrame.
+    
+    Args:
+        expr (dict): The filter expression to evaluate
+        frame (pandas.DataFrame): The rows to filter
+        
+    Returns:
+        pandas.Series: A boolean mask aligned with the rows of the frame
+    """
+    # Rows where the condition is unknown do not match
+    return _frame_condition(expr, frame).fillna(False).astype(bool)
+
+def filter_frame(frame, expr):
+    """
+    Select the rows of a DataFrame matching a filter query.
+    
+    The filter is applied column-wise with vectorized pandas operations,
+    rather than evaluated one row at a time. Missing values follow the SQL
+    semantics of the database: a comparison against a missing value never
+    matches, even when it is negated.
+    
+    Args:
+        frame (pandas.DataFrame): The rows, e.g. as returned by call_weave
+        expr (dict): The filter query, e.g. {"$expr": {"$gt": [...]}}
+        
+    Returns:
+        pandas.Series: A boolean mask selecting the matching rows
+        
+    Raises:
+        ValueError: If the expression uses an unsupported operator
+    """
+    return _frame_mask(expr, frame)
+
+# Comparison operators obtained by negating or swapping the operands of another
+_NEGATED_COMPARISONS = {"$gt": "$lte", "$gte": "$lt", "$lt": "$gte", "$lte": "$gt"}
+_SWAPPED_COMPARISONS = {"$gt": "$lt", "$gte": "$lte", "$lt": "$gt", "$lte": "$gte", "$eq": "$eq"}
+
+def _canonical_key(expr):
+    """Serialize an expression deterministically, for sorting and comparison."""
+    return orjson.dumps(expr, option=orjson.OPT_SORT_KEYS)
+
+def canonicalize_query(expr):
+    """
+    Rewrite a filter query into a canonical form.
+    
+    Queries that only differ in how an equivalent condition is written map to
+    the same canonical form: numbers are normalized to floats, negated
+    comparisons become their complement (which is exact under the SQL
+    semantics of filter_frame, where a negated comparison against a missing
+    value is still false), literals are moved to the right of
+    comparisons, and the operands of $and/$or are flattened, deduplicated and
+    sorted.
+    
+    Args:
+        expr: The filter query, or any sub-expression of it
+        
+    Returns:
+        The canonical form of the expression
+    """
+    if isinstance(expr, bool):
+        return expr
+    if isinstance(expr, (int, float)):
+        return float(expr)
+    if isinstance(expr, list):
+        return [canonicalize_query(item) for item in expr]
+    if not isinstance(expr, dict):
+        return expr
+    if len(expr) != 1:
+        return {key: canonicalize_query(value) for key, value in expr.items()}
+    
+    (operator, operand), = expr.items()
+    
+    if operator == "$not":
+        inner = canonicalize_query(operand[0] if isinstance(operand, list) and len(operand) == 1 else operand)
+        if isinstance(inner, dict) and len(inner) == 1:
+            (inner_operator, inner_operand), = inner.items()
+            if inner_operator == "$not":
+                return inner_operand[0]
+            if inner_operator in _NEGATED_COMPARISONS:
+                return {_NEGATED_COMPARISONS[inner_operator]: inner_operand}
+        return {"$not": [inner]}
+    
+    if operator in ("$and", "$or") and isinstance(operand, list):
+        items = []
+        for item in (canonicalize_query(item) for item in operand):
+            # Flatten nested operators of the same kind
+            if isinstance(item, dict) and list(item) == [operator]:
+                items.extend(item[operator])
+            else:
+                items.append(item)
+        unique = {_canonical_key(item): item for item in items}
+        items = [unique[key] for key in sorted(unique)]
+        return items[0] if len(items) == 1 else {operator: items}
+    
+    if operator in _SWAPPED_COMPARISONS and isinstance(operand, list) and len(operand) == 2:
+        left, right = (canonicalize_query(item) for item in operand)
+        # Keep literals on the right-hand side of comparisons
+        if isinstance(left, dict) and list(left) == ["$literal"] and not (
+            isinstance(right, dict) and list(right) == ["$literal"]
+        ):
+            return {_SWAPPED_COMPARISONS[operator]: [right, left]}
+        if operator == "$eq" and _canonical_key(left) > _canonical_key(right):
+            left, right = right, left
+        return {operator: [left, right]}
+    
+    return {operator: canonicalize_query(operand)}
+
+def queries_match(query, other):
+    """
+    Check whether two filter queries are equivalent up to canonicalization.
+    
+    Args:
+        query (dict): The first filter query
+        other (dict): The second filter query
+        
+    Returns:
+        bool: True if both queries have the same canonical form
+    """
+    return _canonical_key(canonicalize_query(query)) == _canonical_key(canonicalize_query(other))
+
+def _literal_value(expr):
+    """Return the boolean value of a literal expression, or None if it is not one."""
+    if isinstance(expr, dict) and list(expr) == ["$literal"] and isinstance(expr["$literal"], bool):
+        return expr["$literal"]
+    return None
+
+def optimize_expr(expr):
+    """
+    Simplify a generated filter query before it is sent to the database.
+    
+    Only rewrites that keep the query within the operators supported by Weave
+    are applied: double negations are removed, nested $and/$or operators are
+    flattened and their duplicate operands dropped, comparisons between two
+    literals are folded into a constant, and constant operands of $and/$or
+    are eliminated. Unlike canonicalize_query, the order of the operands is
+    preserved and numbers keep their type. The root of a query is never
+    folded into a constant, since $expr must hold an operation, and
+    malformed nodes are left unchanged.
+    
+    Args:
+        expr: The filter query, or any sub-expression of it
+        
+    Returns:
+        An equivalent, possibly smaller, expression
+    """
+    if isinstance(expr, list):
+        return [optimize_expr(item) for item in expr]
+    if not isinstance(expr, dict) or len(expr) != 1:
+        return expr
+    
+    (operator, operand), = expr.items()
+    
+    if operator == "$expr":
+        optimized = optimize_expr(operand)
+        # Keep the original query when it always or never matches
+        if isinstance(optimized, dict) and list(optimized) == ["$literal"]:
+            return expr
+        return {"$expr": optimized}
+    
+    if operator == "$not":
+        if not isinstance(operand, list) or len(operand) != 1:
+            return expr
+        inner = optimize_expr(operand[0])
+        value = _literal_value(inner)
+        if value is not None:
+            return {"$literal": not value}
+        twice = inner.get("$not") if isinstance(inner, dict) and list(inner) == ["$not"] else None
+        if isinstance(twice, list) and len(twice) == 1:
+            return twice[0]
+        return {"$not": [inner]}
+    
+    if operator in ("$and", "$or") and isinstance(operand, list):
+        # The operand value that decides the whole expression on its own
+        absorbing = operator == "$or"
+        items = {}
+        for item in (optimize_expr(item) for item in operand):
+            # Flatten nested operators of the same kind
+            for child in item[operator] if isinstance(item, dict) and list(item) == [operator] else [item]:
+                value = _literal_value(child)
+                if value is None:
+                    items.setdefault(_canonical_key(child), child)
+                elif value == absorbing:
+                    return {"$literal": absorbing}
+        if not items:
+            return {"$literal": not absorbing}
+        items = list(items.values())
+        return items[0] if len(items) == 1 else {operator: items}
+    
+    if operator in _FRAME_COMPARISONS and isinstance(operand, list) and len(operand) == 2:
+        left, right = (optimize_expr(item) for item in operand)
+        if all(isinstance(item, dict) and list(item) == ["$literal"] for item in (left, right)):
+            try:
+                return {"$literal": bool(_FRAME_COMPARISONS[operator](left["$literal"], right["$literal"]))}
+            except TypeError:
+                pass
+        return {operator: [left, right]}
+    
+    return {operator: optimize_expr(operand)}
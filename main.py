@@ -10,16 +10,37 @@ Author: Prateek Chhikara
 
 import streamlit as st
 import time
-import json
+import orjson
 import weave
 import os
+from dataclasses import dataclass, asdict
+from typing import Any, Optional
 from dotenv import load_dotenv
-from utils import audio2text, start_recording, stop_recording, generate_response, get_fields_description, call_weave
-from prompts import COLUMN_SELECTION_PROMPT, QUERY_PROMPT, SORT_BY_PROMPT
-from config import PROJECT_NAME
+from utils import audio2text, start_recording, stop_recording, is_recording_truncated, generate_response, get_fields_description, prefetch_fields_description, call_weave, ALLOWED_COLUMNS
+from filters import optimize_expr
+from prompts import COMBINED_PROMPT
+from config import PROJECT_NAME, MAX_RECORDING_SECONDS
 # Load environment variables
 load_dotenv()
 
+@dataclass(slots=True)
+class SessionDefaults:
+    """Default values of the session state variables."""
+    recording: bool = False
+    audio_file: Optional[bytes] = None
+    query_result: Optional[str] = None
+    required_columns: Optional[list] = None
+    final_query: Optional[dict] = None
+    stream: Any = None
+    weave_response: Any = None
+    status_code: Optional[int] = None
+    sort_by_query: Optional[list] = None
+    record_start: Optional[float] = None
+    fields_description: Any = None
+    recording_truncated: bool = False
+
+SESSION_DEFAULTS = asdict(SessionDefaults())
+
 def main():
     """
     Main function that runs the Streamlit application.
@@ -29,7 +50,7 @@ def main():
     generates database queries, and displays the results.
     """
     # Initialize weave with project name
-    weave.init(PROJECT_NAME)
+    init_weave()
 
     # Set page configuration and styling
     st.set_page_config(
@@ -55,13 +76,26 @@ def main():
         display_recording_progress()
     
     # Process the audio file if it exists
-    if st.session_state.audio_file and not st.session_state.query_result:
+    if st.session_state.audio_file is not None and not st.session_state.query_result:
         process_audio_file()
     
     # Display results if available
     if st.session_state.query_result:
         display_results()
 
+@st.cache_resource
+def init_weave():
+    """
+    Initialize the Weave client with the project name.
+    
+    Streamlit re-executes the script on every interaction, so the client is
+    cached as a resource and only initialized once per process.
+    
+    Returns:
+        WeaveClient: The initialized Weave client
+    """
+    return weave.init(PROJECT_NAME)
+
 def apply_custom_css():
     """Apply custom CSS styling to the Streamlit application."""
     st.markdown("""
@@ -85,21 +119,8 @@ def display_header():
 
 def initialize_session_state():
     """Initialize all required session state variables if they don't exist."""
-    session_vars = {
-        'recording': False,
-        'audio_file': None,
-        'query_result': None,
-        'required_columns': None,
-        'final_query': None,
-        'stream': None,
-        'weave_response': None,
-        'status_code': None,
-        'sort_by_query': None
-    }
-    
-    for var, default in session_vars.items():
-        if var not in st.session_state:
-            st.session_state[var] = default
+    for var, default in SESSION_DEFAULTS.items():
+        st.session_state.setdefault(var, default)
 
 def display_recording_controls():
     """Display the recording control buttons."""
@@ -116,6 +137,9 @@ def display_recording_controls():
                 st.session_state.required_columns = None
                 st.session_state.final_query = None
                 st.session_state.stream = start_recording()
+                st.session_state.record_start = time.monotonic()
+                # Prepare the column descriptions while the user is speaking
+                st.session_state.fields_description = prefetch_fields_description()
                 st.rerun()
         
         # Stop recording button
@@ -124,17 +148,23 @@ def display_recording_controls():
                 st.session_state.recording = False
                 if st.session_state.stream:
                     st.session_state.audio_file = stop_recording(st.session_state.stream)
+                    st.session_state.recording_truncated = is_recording_truncated()
                     st.session_state.stream = None
                 st.rerun()
 
+@st.fragment(run_every=1)
 def display_recording_progress():
-    """Display a progress bar during recording."""
+    """
+    Display the recording status with the elapsed recording time.
+    
+    This runs as a fragment refreshed every second, so only the status panel
+    re-renders while recording instead of the whole application.
+    """
     st.markdown("---")
-    st.info("🎙️ Recording in progress... Press 'Stop Recording' when finished.")
-    progress_bar = st.progress(0)
-    for i in range(100):
-        time.sleep(0.01)
-        progress_bar.progress(i + 1)
+    elapsed = time.monotonic() - st.session_state.record_start
+    st.info(f"🎙️ Recording in progress ({elapsed:.0f}s)... Press 'Stop Recording' when finished.")
+    if elapsed > MAX_RECORDING_SECONDS:
+        st.warning(f"⚠️ Recordings are limited to {MAX_RECORDING_SECONDS} seconds, further audio is not kept.")
 
 def process_audio_file():
     """
@@ -147,49 +177,40 @@ def process_audio_file():
         # Transcribe the audio
         st.session_state.query_result = audio2text(st.session_state.audio_file)
         
-        # Get column descriptions
-        columns_with_description_str = get_fields_description()
+        # Get column descriptions, prepared in the background during recording
+        if st.session_state.fields_description is not None:
+            columns_with_description_str = st.session_state.fields_description.result()
+        else:
+            columns_with_description_str = get_fields_description()
         
-        # Generate required columns
-        st.session_state.required_columns = generate_response(
+        # Generate the required columns, final query and sort by query in a single request
+        response = generate_response(
             st.session_state.query_result, 
             columns_with_description_str, 
             "", 
-            COLUMN_SELECTION_PROMPT
-        )['columns']
+            COMBINED_PROMPT
+        )
+        # Simplify the generated query before it is executed
+        st.session_state.final_query = optimize_expr(response['query'])
+        st.session_state.sort_by_query = response['sort_by']
 
         # Filter columns to only include those in the allowed list
-        with open("columns.json", "r") as f:
-            columns_with_description = json.load(f)
-        
-        allowed_columns = list(columns_with_description.keys())
         st.session_state.required_columns = [
-            column for column in st.session_state.required_columns 
-            if column in allowed_columns
+            column for column in response['columns'] 
+            if column in ALLOWED_COLUMNS
         ]
-
-        # Generate final query
-        st.session_state.final_query = generate_response(
-            st.session_state.query_result, 
-            columns_with_description_str, 
-            st.session_state.required_columns, 
-            QUERY_PROMPT
-        )['query']
-
-        # Generate sort by query
-        st.session_state.sort_by_query = generate_response(
-            st.session_state.query_result, 
-            columns_with_description_str, 
-            st.session_state.required_columns, 
-            SORT_BY_PROMPT
-        )['sort_by']
         
-        # Call weave endpoint to execute the query
+        # Call weave endpoint to execute the query, fetching only the required columns
         st.session_state.weave_response, st.session_state.status_code = call_weave(
             st.session_state.final_query, 
-            st.session_state.sort_by_query
+            st.session_state.sort_by_query,
+            st.session_state.required_columns
         )
 
+def format_json(obj):
+    """Serialize an object to an indented JSON string for display."""
+    return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+
 def display_results():
     """Display the query results and processing information."""
     st.markdown("---")
@@ -200,18 +221,20 @@ def display_results():
     with col1:
         st.markdown("### 📝 Transcribed Text")
         st.info(st.session_state.query_result)
+        if st.session_state.recording_truncated:
+            st.warning(f"⚠️ Only the first {MAX_RECORDING_SECONDS} seconds of the recording were transcribed.")
     
     with col2:
         st.markdown("### 📊 Required Columns")
-        st.code(json.dumps(st.session_state.required_columns, indent=2), language='json')
+        st.code(format_json(st.session_state.required_columns), language='json')
     
     with col3:
         st.markdown("### 🔍 Generated Query")
-        st.code(json.dumps(st.session_state.final_query, indent=2), language='json')
+        st.code(format_json(st.session_state.final_query), language='json')
     
     with col4:
         st.markdown("### 🔍 Sort By Query")
-        st.code(json.dumps(st.session_state.sort_by_query, indent=2), language='json')
+        st.code(format_json(st.session_state.sort_by_query), language='json')
 
     # Display weave response which is a dataframe
     st.markdown("### 📊 Weave Response")
@@ -230,20 +253,7 @@ def display_results():
 
 def reset_session_state():
     """Reset all session state variables to their default values."""
-    session_vars = {
-        'recording': False,
-        'audio_file': None,
-        'query_result': None,
-        'required_columns': None,
-        'final_query': None,
-        'stream': None,
-        'weave_response': None,
-        'status_code': None,
-        'sort_by_query': None
-    }
-    
-    for var, default in session_vars.items():
-        st.session_state[var] = default
+    st.session_state.update(SESSION_DEFAULTS)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
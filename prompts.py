@@ -8,72 +8,41 @@ guide the model in generating appropriate responses.
 Author: Prateek Chhikara
 """
 
-# Prompt for selecting relevant columns based on the user query
-COLUMN_SELECTION_PROMPT = """
-You are a data analysis assistant tasked with selecting relevant columns for query analysis.
-Given a list of columns with their descriptions below:
+# System prompt listing the database columns. It is sent first and is identical
+# for every request, so that providers can serve it from their prompt cache.
+COLUMNS_DESCRIPTION_PROMPT = """
+Below is a list of columns with their descriptions:
 
 {{columns_with_description}}
-
-Your task is to identify and return ONLY the columns that are directly relevant to answering the given query.
-First, analyze the query to understand the filtering conditions needed. Generate an explanation of the query before selecting the columns.
-
-# Instructions:
-1. Analyze the query carefully to understand what data points are needed
-2. Select ONLY the columns necessary to answer the query - avoid including irrelevant columns
-3. Return your response in this JSON format:
-{
-    "columns": ["column1", "column2", ...]
-}
-
-Note: Always include identifier columns (like model_name) when the query requires identifying specific models or comparing between models.
-
-# Examples:
-
-Query: Which model had the highest accuracy?
-Explanation: We need the model name to identify which model, and the accuracy metric to find the highest.
-Columns: {
-    "columns": ['attributes.model_name', 'output.HalluScorerEvaluator.scorer_evaluation_metrics.accuracy']
-}
-
-Query: Find all the models that had a precision score greater than 0.8
-Explanation: We need the model name to identify models and precision score to filter above 0.8.
-Columns: {
-    "columns": ['attributes.model_name', 'output.HalluScorerEvaluator.scorer_evaluation_metrics.precision'] 
-}
-
-Query: Give me the list of all models that were trained for more than 10 epochs
-Explanation: We need model name to identify models and num_train_epochs to filter by training duration.
-Columns: {
-    "columns": ['attributes.model_name', 'attributes.num_train_epochs']
-}
-
-Query: Return all the rows where the latency was greater than 100ms
-Explanation: We only need the latency metric to filter by the threshold.
-Columns: {
-    "columns": ['output.model_latency.mean']
-}
-
-Query: {{query}}
 """
 
-# Prompt for generating a database query based on the user query and selected columns
-QUERY_PROMPT = """
+# Instructions for selecting relevant columns and generating a database query and sort criteria
+COMBINED_INSTRUCTIONS = """
 You are a data analysis assistant specializing in query generation.
-Below is a list of columns with their descriptions:
-{{columns_with_description}}
+Use the list of columns with their descriptions given above.
 
-You will be given a query and the selected columns for analysis. Your task is to generate a filter query that filters data based on the query.
+You will be given a query. Your task is to first select the columns that are directly relevant to answering the query, then generate a filter query over those columns that filters data based on the query, and finally generate a sort by query that sorts the data based on the query.
 
 # Instructions:
-1. Analyze the query to understand the filtering conditions needed
-2. Use proper operators ($eq, $gt, $gte, $and, $or, $not, $contains) based on the query. Do not use any other operators.
-3. Always convert numeric fields using $convert operator to ensure proper comparisons
-4. Return the response in this exact JSON format:
+1. Analyze the query carefully to understand what data points and filtering conditions are needed
+2. Select ONLY the columns necessary to answer the query - avoid including irrelevant columns
+3. Always include identifier columns (like model_name) when the query requires identifying specific models or comparing between models
+4. Use proper operators ($eq, $gt, $gte, $and, $or, $not, $contains) based on the query. Do not use any other operators.
+5. Always convert numeric fields using $convert operator to ensure proper comparisons
+6. Only sort when the query asks for an order (e.g. "desc" for the highest values, "asc" for the lowest or for ascending order); otherwise return an empty "sort_by" list
+7. Only filter when the query states a condition; a query that only asks for an order has a null "query"
+8. Return the response in this exact JSON format:
 {
+    "columns": ["column1", "column2", ...],
     "query": {
         //  query here
-    }
+    },
+    "sort_by": [
+        {
+            "field": "column_name",
+            "direction": "asc" or "desc"
+        }
+    ]
 }
 
 # Remember to use the correct operators for the query.
@@ -141,13 +110,49 @@ query = {
         }
     }
 }
-    
+
 
 # Below are the examples of the queries:
 
+Query: Find models with the highest accuracy
+{
+    "columns": ["attributes.model_name", "output.HalluScorerEvaluator.scorer_evaluation_metrics.accuracy"],
+    "query": null,
+    "sort_by": [
+        {
+            "field": "output.HalluScorerEvaluator.scorer_evaluation_metrics.accuracy",
+            "direction": "desc"
+        }
+    ]
+}
+
+Query: Find models with the lowest latency
+{
+    "columns": ["attributes.model_name", "output.model_latency.mean"],
+    "query": null,
+    "sort_by": [
+        {
+            "field": "output.model_latency.mean",
+            "direction": "asc"
+        }
+    ]
+}
+
+Query: Return the rows in ascending order of the model precision
+{
+    "columns": ["output.HalluScorerEvaluator.scorer_evaluation_metrics.precision"],
+    "query": null,
+    "sort_by": [
+        {
+            "field": "output.HalluScorerEvaluator.scorer_evaluation_metrics.precision",
+            "direction": "asc"
+        }
+    ]
+}
+
 Query: Find all the rows where the latency was greater than 100ms
-Columns: ['output.model_latency.mean']
 {
+    "columns": ["output.model_latency.mean"],
     "query": {
         "$expr": {
             "$gt": [
@@ -160,12 +165,13 @@ Columns: ['output.model_latency.mean']
                 {"$literal": 100}
             ]
         }
-    }
+    },
+    "sort_by": []
 }
 
 Query: Find models with accuracy above 0.9
-Columns: ['attributes.model_name', 'output.HalluScorerEvaluator.scorer_evaluation_metrics.accuracy']
 {
+    "columns": ["attributes.model_name", "output.HalluScorerEvaluator.scorer_evaluation_metrics.accuracy"],
     "query": {
         "$expr": {
             "$gt": [
@@ -178,12 +184,13 @@ Columns: ['attributes.model_name', 'output.HalluScorerEvaluator.scorer_evaluatio
                 {"$literal": 0.9}
             ]
         }
-    }
+    },
+    "sort_by": []
 }
 
 Query: Find models trained for more than 5 epochs with learning rate below 0.001
-Columns: ['attributes.model_name', 'attributes.num_train_epochs', 'attributes.learning_rate']
 {
+    "columns": ["attributes.model_name", "attributes.num_train_epochs", "attributes.learning_rate"],
     "query": {
         "$expr": {
             "$and": [
@@ -213,12 +220,13 @@ Columns: ['attributes.model_name', 'attributes.num_train_epochs', 'attributes.le
                 }
             ]
         }
-    }
+    },
+    "sort_by": []
 }
 
 Query: Find all the rows where the model name contains 'gpt'
-Columns: ['attributes.model_name']
 {
+    "columns": ["attributes.model_name"],
     "query": {
         "$expr": {
             "$contains": {
@@ -226,71 +234,97 @@ Columns: ['attributes.model_name']
                 "substr": {"$literal": "gpt"}
             }
         }
-    }
+    },
+    "sort_by": []
 }
-
-
-Query: {{query}}
-Columns: {{columns}}
 """
 
-# Prompt for generating sort criteria based on the user query
-SORT_BY_PROMPT = """
-You are a data analysis assistant specializing in query generation.
-Below is a list of columns with their descriptions:
-{{columns_with_description}}
-
-Your task is to generate a sort by query that sorts the data based on a given query.
-
-# Instructions:
-1. Analyze the query to understand the sorting conditions needed
-2. Use proper sort by based on the query
-3. Return the response in this exact JSON format:
-{
-    "sort_by" : [
-        {
-            "field":"column_name",
-            "direction":"asc" or "desc"
-        }
-    ]
-}
-
-# Examples:
-
-Query: Find models with the highest accuracy
-Columns: ['output.HalluScorerEvaluator.scorer_evaluation_metrics.accuracy']
-Output: {
-    "sort_by" : [
-        {
-            "field":"output.HalluScorerEvaluator.scorer_evaluation_metrics.accuracy",
-            "direction":"desc"
-        }
-    ]
-}
+def _operator_schema(operator, operand):
+    """Build the schema of an object holding a single query operator."""
+    return {
+        "type": "object",
+        "properties": {operator: operand},
+        "required": [operator],
+        "additionalProperties": False
+    }
 
-Query: Find models with the lowest latency
-Columns: ['output.model_latency.mean']
-Output: {
-    "sort_by" : [
-        {
-            "field":"output.model_latency.mean",
-            "direction":"asc"
+# JSON schema of the combined response. The filter query is described recursively
+# with the allowed operators only, so that strict structured outputs can
+# guarantee a valid response on the first attempt.
+COMBINED_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "columns": {"type": "array", "items": {"type": "string"}},
+        "query": {"anyOf": [_operator_schema("$expr", {"$ref": "#/$defs/expression"}), {"type": "null"}]},
+        "sort_by": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "field": {"type": "string"},
+                    "direction": {"type": "string", "enum": ["asc", "desc"]}
+                },
+                "required": ["field", "direction"],
+                "additionalProperties": False
+            }
         }
-    ]
+    },
+    "required": ["columns", "query", "sort_by"],
+    "additionalProperties": False,
+    "$defs": {
+        "expression": {
+            "anyOf": [
+                _operator_schema("$and", {"type": "array", "items": {"$ref": "#/$defs/expression"}}),
+                _operator_schema("$or", {"type": "array", "items": {"$ref": "#/$defs/expression"}}),
+                _operator_schema("$not", {"type": "array", "items": {"$ref": "#/$defs/expression"}}),
+                _operator_schema("$eq", {"type": "array", "items": {"$ref": "#/$defs/operand"}}),
+                _operator_schema("$gt", {"type": "array", "items": {"$ref": "#/$defs/operand"}}),
+                _operator_schema("$gte", {"type": "array", "items": {"$ref": "#/$defs/operand"}}),
+                _operator_schema("$contains", {
+                    "type": "object",
+                    "properties": {
+                        "input": {"$ref": "#/$defs/operand"},
+                        "substr": {"$ref": "#/$defs/literal"}
+                    },
+                    "required": ["input", "substr"],
+                    "additionalProperties": False
+                })
+            ]
+        },
+        "operand": {
+            "anyOf": [
+                _operator_schema("$convert", {
+                    "type": "object",
+                    "properties": {
+                        "input": {"$ref": "#/$defs/field"},
+                        "to": {"type": "string", "enum": ["double", "int", "string"]}
+                    },
+                    "required": ["input", "to"],
+                    "additionalProperties": False
+                }),
+                {"$ref": "#/$defs/field"},
+                {"$ref": "#/$defs/literal"}
+            ]
+        },
+        "field": _operator_schema("$getField", {"type": "string"}),
+        "literal": _operator_schema("$literal", {"anyOf": [{"type": "number"}, {"type": "string"}, {"type": "boolean"}]})
+    }
 }
 
-Query: Return the rows in ascending order of the model precision
-Columns: ['output.HalluScorerEvaluator.scorer_evaluation_metrics.precision']
-Output: {
-    "sort_by" : [
-        {
-            "field":"output.HalluScorerEvaluator.scorer_evaluation_metrics.precision",
-            "direction":"asc"
+# Prompt for selecting relevant columns and generating a database query and sort criteria in a single request.
+# The static instructions are sent as a system message ahead of the per-request input,
+# so the whole instruction block is part of the cacheable prompt prefix.
+COMBINED_PROMPT = {
+    "system": COMBINED_INSTRUCTIONS,
+    "user": """
+Query: {{query}}
+""",
+    "response_format": {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "combined_query",
+            "strict": True,
+            "schema": COMBINED_RESPONSE_SCHEMA
         }
-    ]
+    }
 }
-
-Query: {{query}}
-Columns: {{columns}}
-Output:
-"""
\ No newline at end of file
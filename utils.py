@@ -7,22 +7,25 @@ including audio recording and processing, API interactions, and database queries
 Author: Prateek Chhikara
 """
 
-# import whisper
+import io
 import wave
-import sounddevice as sd
 import numpy as np
-import requests
 import threading
 import pandas as pd
-import queue
-import json
+import orjson
 import time
+import functools
+import hashlib
+import inspect
+import httpx
 import weave
 import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from jinja2 import Template
-from prompts import COLUMN_SELECTION_PROMPT, QUERY_PROMPT
-from config import MODEL_NAME, DATASET_DB
+from prompts import COLUMNS_DESCRIPTION_PROMPT
+from config import MODEL_NAME, MODEL_TEMPERATURE, TRANSCRIPTION_MODEL, LLM_CACHE_SIZE, DATASET_DB, PROJECT_NAME, MAX_RECORDING_SECONDS
 
 # Load environment variables
 load_dotenv()
@@ -34,17 +37,99 @@ SAMPLE_RATE = 16000
 # Initialize OpenAI client
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
-PIPECAT_URL = "http://localhost:8000/transcribe"  # PipeCat STT API endpoint
+from openai import OpenAI, AsyncOpenAI
 
-from openai import OpenAI
+# Share pooled HTTP/2 connections across all API calls so TLS handshakes are
+# only paid when a connection is first opened. Idle connections are kept for
+# longer than httpx's 5 second default, so they survive the time a user takes
+# to record the next query
+HTTP_TIMEOUT = 60
+HTTP_KEEPALIVE_EXPIRY = 120
+HTTP_LIMITS = httpx.Limits(
+    max_connections=32,
+    max_keepalive_connections=32,
+    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+)
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+client = OpenAI(
+    api_key=OPENAI_API_KEY,
+    http_client=httpx.Client(http2=True, timeout=HTTP_TIMEOUT, limits=HTTP_LIMITS)
+)
+async_client = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    http_client=httpx.AsyncClient(http2=True, timeout=HTTP_TIMEOUT, limits=HTTP_LIMITS)
+)
+
+class LLMCache:
+    """
+    In-memory exact-match cache of LLM responses.
+    
+    Responses are keyed by a SHA-256 hash of the whole request, including the
+    model, the rendered messages, the response format and the temperature, and
+    the least recently used entries are evicted once the cache holds more than
+    `maxsize` responses. Raw response contents are stored, so each hit is
+    parsed into a fresh object that callers are free to modify.
+    """
+    
+    def __init__(self, maxsize=LLM_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def make_key(request):
+        """Compute the cache key of a request, given its API keyword arguments."""
+        return hashlib.sha256(orjson.dumps(request, option=orjson.OPT_SORT_KEYS)).hexdigest()
+    
+    def get(self, key):
+        """Return the cached response content for a key, or None on a miss."""
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+    
+    def set(self, key, content):
+        """Store the response content for a key."""
+        with self._lock:
+            self._entries[key] = content
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+# Response format used by prompts that do not define a JSON schema
+JSON_OBJECT_FORMAT = {"type": "json_object"}
+
+# Responses are only cached when generation is deterministic
+llm_cache = LLMCache() if MODEL_TEMPERATURE == 0.0 else None
+
+# Runs background work, such as preparing prompt inputs while the user is speaking
+background_executor = ThreadPoolExecutor(max_workers=2)
+
+# Guards the creation of Weave clients, since weave.init is not reentrant
+weave_client_lock = threading.Lock()
 
 # Global variables for recording
-audio_queue = queue.Queue()
-recording_thread = None
+recording_lock = threading.Lock()
+recording_buffer = None
+recording_sample_rate = SAMPLE_RATE
+recorded_frames = 0
+recording_truncated = False
 is_recording = False
 
+@functools.lru_cache(maxsize=None)
+def compile_template(prompt_template):
+    """
+    Compile a Jinja2 template, once per distinct template source.
+    
+    Args:
+        prompt_template (str): The Jinja2 template source
+        
+    Returns:
+        jinja2.Template: The compiled template
+    """
+    return Template(prompt_template)
+
 def render_prompt(query, columns_with_description, fetched_columns, prompt_template):
     """
     Render a prompt template with the provided variables.
@@ -58,27 +143,52 @@ def render_prompt(query, columns_with_description, fetched_columns, prompt_templ
     Returns:
         str: The rendered prompt text
     """
-    template = Template(prompt_template)
+    template = compile_template(prompt_template)
     return template.render(
         query=query, 
         columns_with_description=columns_with_description, 
         columns=fetched_columns
     )
 
-@weave.op()
+def _summarize_audio_inputs(inputs):
+    """
+    Replace in-memory audio in traced inputs with a short summary.
+    
+    Args:
+        inputs (dict): The inputs of the audio2text call
+        
+    Returns:
+        dict: The inputs to log, without the raw recording
+    """
+    audio_file = inputs.get("audio_file")
+    if isinstance(audio_file, bytes):
+        return {**inputs, "audio_file": f"<WAV audio, {len(audio_file)} bytes>"}
+    return inputs
+
+# The recording itself is not logged, so traces stay small
+@weave.op(postprocess_inputs=_summarize_audio_inputs)
 def audio2text(audio_file):
     """
-    Transcribe an audio file to text using OpenAI's Whisper API.
+    Transcribe an audio file to text using OpenAI's transcription API.
     
     Args:
-        audio_file (str): Path to the audio file to transcribe
+        audio_file (str or bytes): Path to the audio file to transcribe, or
+            the WAV-encoded audio as returned by stop_recording
         
     Returns:
         str: The transcribed text
     """
+    # Recordings kept in memory are uploaded directly, without touching the disk
+    if isinstance(audio_file, bytes):
+        return client.audio.transcriptions.create(
+            model=TRANSCRIPTION_MODEL,
+            file=("audio.wav", audio_file),
+            response_format="text"
+        )
+    
     with open(audio_file, "rb") as audio:
         transcript = client.audio.transcriptions.create(
-            model="whisper-1",
+            model=TRANSCRIPTION_MODEL,
             file=audio,
             response_format="text"
         )
@@ -89,7 +199,8 @@ def audio_callback(indata, frames, time, status):
     Callback function for audio recording.
     
     This function is called for each audio block during recording
-    and adds the audio data to the queue.
+    and copies the audio data into the preallocated recording buffer,
+    so the real-time audio thread never allocates memory or does disk I/O.
     
     Args:
         indata (numpy.ndarray): The recorded audio data
@@ -97,8 +208,16 @@ def audio_callback(indata, frames, time, status):
         time (CData): Time information
         status (CallbackFlags): Status flags
     """
-    if is_recording:
-        audio_queue.put(indata.copy())
+    global recorded_frames, recording_truncated
+    
+    with recording_lock:
+        if is_recording and recording_buffer is not None:
+            count = min(frames, len(recording_buffer) - recorded_frames)
+            recording_buffer[recorded_frames:recorded_frames + count] = indata[:count, 0]
+            recorded_frames += count
+            # Audio beyond MAX_RECORDING_SECONDS does not fit in the buffer
+            if count < frames:
+                recording_truncated = True
 
 def start_recording(sample_rate=SAMPLE_RATE):
     """
@@ -110,13 +229,22 @@ def start_recording(sample_rate=SAMPLE_RATE):
     Returns:
         sd.InputStream: The audio stream object
     """
-    global is_recording, recording_thread, audio_queue
+    global is_recording, recording_buffer, recording_sample_rate, recorded_frames, recording_truncated
     
-    # Clear the queue
-    while not audio_queue.empty():
-        audio_queue.get()
+    # Imported here so the audio backend is only loaded when recording
+    import sounddevice as sd
+    
+    # Allocate the buffer that the audio blocks are copied into, reusing
+    # the buffer of the previous recording when it has the same size
+    with recording_lock:
+        capacity = sample_rate * MAX_RECORDING_SECONDS
+        if recording_buffer is None or len(recording_buffer) != capacity:
+            recording_buffer = np.empty(capacity, dtype=np.int16)
+        recording_sample_rate = sample_rate
+        recorded_frames = 0
+        recording_truncated = False
+        is_recording = True
     
-    is_recording = True
     print("🎙️ Recording... Speak now!")
     
     # Start the stream
@@ -130,45 +258,57 @@ def start_recording(sample_rate=SAMPLE_RATE):
     
     return stream
 
-def stop_recording(stream, filename="audio.wav", sample_rate=SAMPLE_RATE):
+def stop_recording(stream):
     """
-    Stop recording and save the audio to a file.
+    Stop recording and encode the recorded audio.
+    
+    The recording is encoded as WAV in memory, so it can be transcribed
+    without being written to and read back from disk.
     
     Args:
         stream (sd.InputStream): The audio stream to stop
-        filename (str): Path to save the recorded audio
-        sample_rate (int): The sample rate of the audio
         
     Returns:
-        str: Path to the saved audio file, or None if no audio was recorded
+        bytes: The WAV-encoded audio, or None if no audio was recorded
     """
-    global is_recording, audio_queue
+    global is_recording
     
-    is_recording = False
     stream.stop()
     stream.close()
     
-    # Get all audio data from the queue
-    audio_data = []
-    while not audio_queue.empty():
-        audio_data.append(audio_queue.get())
+    # Take the recorded part of the buffer together with the end of recording,
+    # so no block delivered afterwards can leak into it
+    with recording_lock:
+        is_recording = False
+        samples = recording_buffer[:recorded_frames].tobytes()
+        sample_rate = recording_sample_rate
     
-    if not audio_data:
+    if not samples:
         print("No audio data recorded!")
         return None
     
-    # Combine all audio chunks
-    audio = np.concatenate(audio_data)
+    if recording_truncated:
+        print(f"⚠️ Recording exceeded {MAX_RECORDING_SECONDS} seconds, later audio was dropped")
     
-    # Save to WAV file
-    with wave.open(filename, "wb") as wf:
+    # Encode the recorded audio as WAV
+    audio = io.BytesIO()
+    with wave.open(audio, "wb") as wf:
         wf.setnchannels(1)
         wf.setsampwidth(2)
         wf.setframerate(sample_rate)
-        wf.writeframes(audio.tobytes())
+        wf.writeframes(samples)
     
     print("✅ Recording complete!")
-    return filename
+    return audio.getvalue()
+
+def is_recording_truncated():
+    """
+    Check whether the last recording exceeded MAX_RECORDING_SECONDS.
+    
+    Returns:
+        bool: True if audio was dropped because the recording was too long
+    """
+    return recording_truncated
 
 def record_audio(filename="audio.wav", duration=None, sample_rate=SAMPLE_RATE):
     """
@@ -186,20 +326,28 @@ def record_audio(filename="audio.wav", duration=None, sample_rate=SAMPLE_RATE):
         str: Path to the saved audio file, or None if duration is not provided
     """
     if duration is not None:
-        print(f"🎙️ Recording for {duration} seconds...")
-        audio = sd.rec(
-            int(sample_rate * duration), 
-            samplerate=sample_rate, 
-            channels=1, 
-            dtype=np.int16
-        )
-        sd.wait()
+        # Imported here so the audio backend is only loaded when recording
+        import sounddevice as sd
         
+        print(f"🎙️ Recording for {duration} seconds...")
         with wave.open(filename, "wb") as wf:
             wf.setnchannels(1)
             wf.setsampwidth(2)
             wf.setframerate(sample_rate)
-            wf.writeframes(audio.tobytes())
+            
+            # Stream each audio block straight into the WAV file, so only
+            # one block is held in memory at a time. The header is only
+            # patched once, when the file is closed
+            def write_block(indata, frames, time, status):
+                wf.writeframesraw(indata)
+            
+            with sd.InputStream(
+                callback=write_block, 
+                channels=1, 
+                samplerate=sample_rate, 
+                dtype=np.int16
+            ):
+                sd.sleep(int(duration * 1000))
         
         print("✅ Recording complete!")
         return filename
@@ -208,6 +356,23 @@ def record_audio(filename="audio.wav", duration=None, sample_rate=SAMPLE_RATE):
         print("For dynamic recording, use start_recording() and stop_recording() instead")
         return None
 
+@functools.lru_cache(maxsize=1)
+def load_columns_with_description():
+    """
+    Load the database column descriptions from the columns.json file.
+    
+    The file is read and parsed only once per process; subsequent calls
+    return the cached dictionary.
+    
+    Returns:
+        dict: A dictionary mapping column names to their descriptions
+    """
+    with open("columns.json", "rb") as f:
+        return orjson.loads(f.read())
+
+# Column names that generated queries are allowed to reference
+ALLOWED_COLUMNS = frozenset(load_columns_with_description())
+
 @weave.op()
 def get_fields_description():
     """
@@ -216,15 +381,113 @@ def get_fields_description():
     Returns:
         str: A formatted string containing column names and their descriptions
     """
-    with open("columns.json", "r") as f:
-        columns_with_description = json.load(f)
+    return format_fields_description()
 
-    columns_with_description_str = ""
+def prefetch_fields_description():
+    """
+    Start preparing the database field descriptions in the background.
+    
+    Returns:
+        concurrent.futures.Future: A future resolving to the formatted field descriptions
+    """
+    return background_executor.submit(get_fields_description)
 
-    for column, description in columns_with_description.items():
-        columns_with_description_str += f"Column: {column}\nDescription: {description}\n\n"
+@functools.lru_cache(maxsize=1)
+def format_fields_description():
+    """
+    Format the database field descriptions, once per process.
+    
+    Returns:
+        str: A formatted string containing column names and their descriptions
+    """
+    return "".join(
+        f"Column: {column}\nDescription: {description}\n\n"
+        for column, description in load_columns_with_description().items()
+    )
 
-    return columns_with_description_str
+def build_messages(query, columns_with_description_str, required_columns, prompt):
+    """
+    Build the chat messages for a prompt.
+    
+    All static content comes first: the column descriptions, shared by all
+    prompts, followed by the static instructions of the prompt. Only the user
+    message depends on the request, so the leading part of every request is
+    byte-identical and can be served from the provider's prompt cache.
+    
+    Args:
+        query (str): The user's query text
+        columns_with_description_str (str): Description of available database columns
+        required_columns (str): Columns that have been selected for the query
+        prompt (dict): The prompt to use, with static "system" instructions
+            and a "user" template
+        
+    Returns:
+        list: The chat messages to send to the API
+    """
+    return [
+        {
+            "role": "system",
+            "content": render_prompt(query, columns_with_description_str, required_columns, COLUMNS_DESCRIPTION_PROMPT)
+        },
+        {
+            "role": "system",
+            "content": prompt["system"]
+        },
+        {
+            "role": "user",
+            "content": render_prompt(query, columns_with_description_str, required_columns, prompt["user"])
+        }
+    ]
+
+def _prepare_completion(query, columns_with_description_str, required_columns, prompt):
+    """
+    Build the API request for a prompt and look up its cached response.
+    
+    Args:
+        query (str): The user's query text
+        columns_with_description_str (str): Description of available database columns
+        required_columns (str): Columns that have been selected for the query
+        prompt (dict): The prompt to use, with "system" and "user" parts and
+            an optional "response_format" constraining the response
+        
+    Returns:
+        tuple: (dict, str, dict or None) - The keyword arguments of the request,
+            its cache key and the parsed cached response, if any
+    """
+    # Build the messages with the provided variables
+    messages = build_messages(
+        query, 
+        columns_with_description_str, 
+        required_columns, 
+        prompt
+    )
+    request = {
+        "model": MODEL_NAME,
+        "messages": messages,
+        "response_format": prompt.get("response_format", JSON_OBJECT_FORMAT),
+        "temperature": MODEL_TEMPERATURE
+    }
+
+    # Serve repeated requests from the response cache
+    cache_key = LLMCache.make_key(request)
+    content = llm_cache.get(cache_key) if llm_cache is not None else None
+    return request, cache_key, orjson.loads(content) if content is not None else None
+
+def _parse_completion(cache_key, response):
+    """
+    Cache the content of an API response and parse it.
+    
+    Args:
+        cache_key (str): The cache key of the request
+        response (ChatCompletion): The response returned by the API
+        
+    Returns:
+        dict: The parsed JSON response
+    """
+    content = response.choices[0].message.content
+    if llm_cache is not None:
+        llm_cache.set(cache_key, content)
+    return orjson.loads(content)
 
 @weave.op()
 def generate_response(query, columns_with_description_str, required_columns, prompt):
@@ -235,58 +498,136 @@ def generate_response(query, columns_with_description_str, required_columns, pro
         query (str): The user's query text
         columns_with_description_str (str): Description of available database columns
         required_columns (str): Columns that have been selected for the query
-        prompt (str): The prompt template to use
+        prompt (dict): The prompt to use, with "system" and "user" parts and
+            an optional "response_format" constraining the response
         
     Returns:
         dict: The parsed JSON response from the API
     """
-    # Render the prompt with the provided variables
-    rendered_prompt = render_prompt(
+    request, cache_key, cached = _prepare_completion(
         query, 
         columns_with_description_str, 
         required_columns, 
         prompt
     )
-
+    if cached is not None:
+        return cached
+    
     # Call the OpenAI API
-    response = client.chat.completions.create(
-        model=MODEL_NAME,
-        messages=[{"role": "user", "content": rendered_prompt}],
-        response_format={"type": "json_object"},
-        temperature=0.0
+    response = client.chat.completions.create(**request)
+    return _parse_completion(cache_key, response)
+
+@weave.op()
+async def agenerate_response(query, columns_with_description_str, required_columns, prompt):
+    """
+    Asynchronously generate a response using the OpenAI API.
+    
+    This is the coroutine counterpart of generate_response, allowing several
+    requests to be in flight at the same time.
+    
+    Args:
+        query (str): The user's query text
+        columns_with_description_str (str): Description of available database columns
+        required_columns (str): Columns that have been selected for the query
+        prompt (dict): The prompt to use, with "system" and "user" parts and
+            an optional "response_format" constraining the response
+        
+    Returns:
+        dict: The parsed JSON response from the API
+    """
+    request, cache_key, cached = _prepare_completion(
+        query, 
+        columns_with_description_str, 
+        required_columns, 
+        prompt
     )
+    if cached is not None:
+        return cached
+    
+    # Call the OpenAI API
+    response = await async_client.chat.completions.create(**request)
+    return _parse_completion(cache_key, response)
+
+@functools.lru_cache(maxsize=4)
+def _init_weave_client(project_name):
+    """
+    Initialize a Weave client for a project, once per project.
+    
+    Args:
+        project_name (str): The Weave project to connect to
+        
+    Returns:
+        WeaveClient: The initialized Weave client
+    """
+    client_db = weave.init(project_name)
+    
+    # weave.init replaces the global client, so switch back to the project
+    # to keep logging traces there
+    weave.init(PROJECT_NAME)
+    return client_db
+
+def get_weave_client(project_name):
+    """
+    Get the cached Weave client for a project.
+    
+    The client is created on first use and reused by later queries, so the
+    authentication handshake is only paid once per project.
     
-    # Return the parsed JSON response
-    return json.loads(response.choices[0].message.content)
+    Args:
+        project_name (str): The Weave project to connect to
+        
+    Returns:
+        WeaveClient: The Weave client for the project
+    """
+    with weave_client_lock:
+        return _init_weave_client(project_name)
 
-def call_weave(query, sort_by=None):
+def call_weave(query, sort_by=None, columns=None):
     """
     Execute a query against the Weave database.
     
     Args:
-        query (dict): The query to execute
-        sort_by (dict, optional): Sorting parameters for the query
+        query (dict): The query to execute, or None to fetch all rows
+        sort_by (list, optional): Sorting parameters for the query; the rows
+            are not sorted if empty
+        columns (list, optional): The columns to fetch; all columns are
+            fetched if not provided
         
     Returns:
         tuple: (pandas.DataFrame, int) - The query results and status code
     """
     try:
-        # Initialize the Weave client
-        client_db = weave.init(DATASET_DB)
+        # Get the Weave client for the dataset
+        client_db = get_weave_client(DATASET_DB)
+        
+        # Only fetch the selected columns when this Weave version can project
+        # them; otherwise they are selected from the full results below
+        projection = {}
+        if columns and "columns" in inspect.signature(client_db.get_calls).parameters:
+            projection["columns"] = list(columns)
         
         # Execute the query
         calls = client_db.get_calls(
             filter={"op_names": ["weave:///c-metrics/hallucination/op/Evaluation.evaluate:*"], 
                     "trace_roots_only": False},
-            sort_by=sort_by,
+            sort_by=sort_by or None,
             query=query,
             limit=10000,
             offset=0,
+            **projection
         )
         
         # Convert the results to a pandas DataFrame
-        return calls.to_pandas(), 200
+        df = calls.to_pandas()
+        
+        # Keep only the selected columns, dropping the call metadata that is
+        # always returned besides them
+        if columns:
+            selected = [column for column in columns if column in df.columns]
+            if selected:
+                df = df[selected]
+        return df, 200
     except Exception as e:
         # Log the error (in a production environment, you would want to log this properly)
         print(f"Error executing Weave query: {str(e)}")
-        return pd.DataFrame(), 500
\ No newline at end of file
+        return pd.DataFrame(), 500